@@ -1,13 +1,98 @@
-import copy
+import threading
 import weakref
-from queue import Empty, Queue
 
 import carla
+import cv2
 import numpy as np
 from gymnasium import spaces
 
 from carla_gym.core.obs_manager.obs_manager import ObsManagerBase
 
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+
+if njit is not None:
+
+    @njit(cache=True, parallel=True, fastmath=True, boundscheck=False)
+    def _bgra_to_rgb_kernel(src, height, width, dst):
+        # Work on flat rows with unit-stride loops so LLVM can lower the 4->3
+        # byte repack to vector shuffles
+        dst_flat = dst.reshape(-1)
+        for y in prange(height):
+            s = src[y * width * 4 : (y + 1) * width * 4]
+            d = dst_flat[y * width * 3 : (y + 1) * width * 3]
+            for x in range(width):
+                d[3 * x] = s[4 * x + 2]
+                d[3 * x + 1] = s[4 * x + 1]
+                d[3 * x + 2] = s[4 * x]
+
+else:
+    _bgra_to_rgb_kernel = None
+
+# The main and BEV cameras may call back concurrently, and the default numba
+# threading layer does not support launching parallel kernels from two threads at once
+_kernel_lock = threading.Lock()
+
+
+def _bgra_to_rgb(raw_data, height, width, dst=None):
+    # View the carla-owned buffer without copying it; `dst` is the only copy made
+    src = np.frombuffer(memoryview(raw_data), dtype=np.dtype("uint8"))
+    if dst is None:
+        dst = np.empty((height, width, 3), dtype=np.uint8)
+    if _bgra_to_rgb_kernel is None:
+        # OpenCV fuses the channel swap and alpha drop into one SIMD pass
+        dst = cv2.cvtColor(src.reshape(height, width, 4), cv2.COLOR_BGRA2RGB, dst=dst)
+    else:
+        with _kernel_lock:
+            _bgra_to_rgb_kernel(src, height, width, dst)
+    return dst
+
+
+def _warmup_bgra_to_rgb(height, width):
+    # Run the conversion once on a blank frame so that JIT compilation (or loading
+    # the cached kernel) happens here instead of delaying the first sensor frame.
+    # `bytes` is read-only like carla's raw_data, so the same kernel signature is built
+    _bgra_to_rgb(bytes(height * width * 4), height, width)
+
+
+class _FrameRing(object):
+    """Preallocated RGB destination buffers reused round-robin by one camera stream."""
+
+    def __init__(self, height, width, size=3):
+        self._buffers = [np.empty((height, width, 3), dtype=np.uint8) for _ in range(size)]
+        self._idx = 0
+
+    def next(self):
+        buf = self._buffers[self._idx]
+        self._idx = (self._idx + 1) % len(self._buffers)
+        return buf
+
+
+class _LatestSlot(object):
+    """Single-producer/single-consumer handoff that only keeps the latest item."""
+
+    def __init__(self):
+        self._item = None
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+
+    def put(self, item):
+        with self._lock:
+            self._item = item
+            self._event.set()
+
+    def get(self, timeout):
+        if not self._event.wait(timeout):
+            return None
+        with self._lock:
+            item = self._item
+            self._item = None
+            self._event.clear()
+        return item
+
 
 class ObsManager(ObsManagerBase):
     """
@@ -18,9 +103,16 @@ class ObsManager(ObsManagerBase):
         "rotation": [0, -15, 0],
         "frame_stack": 1,
         "width": 1920,
-        "height": 1080
+        "height": 1080,
+        "always_decode": False
     }
     frame_stack: [Image(t-2), Image(t-1), Image(t)]
+    always_decode: convert every frame in the sensor callback instead of only
+        converting the latest frame when `get_observation` is called
+
+    The "data" and "bev_data" arrays are reused after two more observations, or
+    after two more sensor frames with always_decode, since frames are then converted
+    as they arrive. Copy them if they have to be kept for longer.
     """
 
     def __init__(self, obs_configs):
@@ -30,6 +122,7 @@ class ObsManager(ObsManagerBase):
         self._width = obs_configs["width"]
         self._fov = obs_configs["fov"]
         self._channels = 3
+        self._always_decode = obs_configs.get("always_decode", False)
         location = carla.Location(
             x=float(obs_configs["location"][0]),
             y=float(obs_configs["location"][1]),
@@ -63,10 +156,12 @@ class ObsManager(ObsManagerBase):
         self._sensor = None
         self._bev_sensor = None
         self._imu_sensor = None
-        self._queue_timeout = 10.0
-        self._image_queue = None
-        self._bev_image_queue = None
-        self._compass_queue = None
+        self._slot_timeout = 10.0
+        self._image_slot = None
+        self._bev_image_slot = None
+        self._compass_slot = None
+        self._image_ring = None
+        self._bev_image_ring = None
 
         super(ObsManager, self).__init__()
 
@@ -92,14 +187,20 @@ class ObsManager(ObsManagerBase):
 
     def attach_ego_vehicle(self, parent_actor):
         init_obs = np.zeros([self._height, self._width, self._channels], dtype=np.uint8)
-        self._image_queue = Queue()
-        self._bev_image_queue = Queue()
-        self._compass_queue = Queue()
+        self._image_slot = _LatestSlot()
+        self._bev_image_slot = _LatestSlot()
+        self._compass_slot = _LatestSlot()
+        self._image_ring = _FrameRing(self._height, self._width)
+        self._bev_image_ring = _FrameRing(self._bev_height, self._bev_width)
 
         self._world = parent_actor.vehicle.get_world()
         weak_self = weakref.ref(self)
+        # every get_blueprint_library() call fetches the library from the server; find()
+        # then returns an independent copy of the blueprint for each sensor
+        blueprint_library = self._world.get_blueprint_library()
+
         # RGB Camera
-        bp = self._world.get_blueprint_library().find("sensor." + self._sensor_type)
+        bp = blueprint_library.find("sensor." + self._sensor_type)
         bp.set_attribute("image_size_x", str(self._width))
         bp.set_attribute("image_size_y", str(self._height))
         bp.set_attribute("fov", str(self._fov))
@@ -112,20 +213,22 @@ class ObsManager(ObsManagerBase):
         self._sensor = self._world.spawn_actor(
             bp, self._camera_transform, attach_to=parent_actor.vehicle
         )
+        _warmup_bgra_to_rgb(self._height, self._width)
         self._sensor.listen(lambda image: self._parse_image(weak_self, image))
 
         # BEV Camera
-        bp = self._world.get_blueprint_library().find("sensor." + self._sensor_type)
+        bp = blueprint_library.find("sensor." + self._sensor_type)
         bp.set_attribute("image_size_x", str(self._bev_width))
         bp.set_attribute("image_size_y", str(self._bev_height))
         bp.set_attribute("fov", str(self._bev_fov))
         self._bev_sensor = self._world.spawn_actor(
             bp, self._bev_transform, attach_to=parent_actor.vehicle
         )
+        _warmup_bgra_to_rgb(self._bev_height, self._bev_width)
         self._bev_sensor.listen(lambda image: self._bev_parse_image(weak_self, image))
 
         # IMU sensor
-        bp = self._world.get_blueprint_library().find("sensor.other.imu")
+        bp = blueprint_library.find("sensor.other.imu")
         bp.set_attribute("sensor_tick", "0.05")
         self._imu_sensor = self._world.spawn_actor(
             bp, carla.Transform(), attach_to=parent_actor.vehicle
@@ -134,18 +237,25 @@ class ObsManager(ObsManagerBase):
 
     def get_observation(self):
         snap_shot = self._world.get_snapshot()
-        assert self._image_queue.qsize() <= 1
-
-        try:
-            frame, data = self._image_queue.get(True, self._queue_timeout)
-            bev_frame, bev_data = self._bev_image_queue.get(True, self._queue_timeout)
-            compass_frame, compass_data = self._compass_queue.get(True, self._queue_timeout)
-            assert snap_shot.frame == frame
-            assert snap_shot.frame == bev_frame
-            assert snap_shot.frame == compass_frame
-        except Empty:
+
+        image = self._image_slot.get(self._slot_timeout)
+        bev_image = self._bev_image_slot.get(self._slot_timeout)
+        compass = self._compass_slot.get(self._slot_timeout)
+        if image is None or bev_image is None or compass is None:
             raise Exception("RGB sensor took too long!")
 
+        frame, data = image
+        bev_frame, bev_data = bev_image
+        compass_frame, compass_data = compass
+        assert snap_shot.frame == frame
+        assert snap_shot.frame == bev_frame
+        assert snap_shot.frame == compass_frame
+        if not self._always_decode:
+            data = _bgra_to_rgb(data.raw_data, data.height, data.width, self._image_ring.next())
+            bev_data = _bgra_to_rgb(
+                bev_data.raw_data, bev_data.height, bev_data.width, self._bev_image_ring.next()
+            )
+
         obs = {
             "frame": frame,
             "data": data,
@@ -171,44 +281,42 @@ class ObsManager(ObsManagerBase):
         self._imu_sensor = None
         self._world = None
 
-        self._image_queue = None
-        self._bev_image_queue = None
-        self._compass_queue = None
+        self._image_slot = None
+        self._bev_image_slot = None
+        self._compass_slot = None
+        self._image_ring = None
+        self._bev_image_ring = None
+
+    def _decode_in_callback(self, carla_image, ring):
+        # Frames overwritten in the slot before being read are then never converted
+        if not self._always_decode:
+            return carla_image
+        return _bgra_to_rgb(
+            carla_image.raw_data, carla_image.height, carla_image.width, ring.next()
+        )
 
     @staticmethod
     def _parse_image(weak_self, carla_image):
         self = weak_self()
 
-        np_img = np.frombuffer(carla_image.raw_data, dtype=np.dtype("uint8"))
-
-        np_img = copy.deepcopy(np_img)
-
-        np_img = np.reshape(np_img, (carla_image.height, carla_image.width, 4))
-        np_img = np_img[:, :, :3]
-        np_img = np_img[:, :, ::-1]
+        np_img = self._decode_in_callback(carla_image, self._image_ring)
 
         # np_img = np.moveaxis(np_img, -1, 0)
         # image = cv2.resize(image, (self._res_x, self._res_y), interpolation=cv2.INTER_AREA)
         # image = np.float32
         # image = (image.astype(np.float32) - 128) / 128
 
-        self._image_queue.put((carla_image.frame, np_img))
+        self._image_slot.put((carla_image.frame, np_img))
 
     @staticmethod
     def _bev_parse_image(weak_self, carla_image):
         self = weak_self()
 
-        np_img = np.frombuffer(carla_image.raw_data, dtype=np.dtype("uint8"))
-
-        np_img = copy.deepcopy(np_img)
-
-        np_img = np.reshape(np_img, (carla_image.height, carla_image.width, 4))
-        np_img = np_img[:, :, :3]
-        np_img = np_img[:, :, ::-1]
+        np_img = self._decode_in_callback(carla_image, self._bev_image_ring)
 
-        self._bev_image_queue.put((carla_image.frame, np_img))
+        self._bev_image_slot.put((carla_image.frame, np_img))
 
     @staticmethod
     def _parse_imu(weak_self, carla_imu):
         self = weak_self()
-        self._compass_queue.put((carla_imu.frame, np.array([carla_imu.compass])))
+        self._compass_slot.put((carla_imu.frame, np.array([carla_imu.compass])))
@@ -2,10 +2,6 @@ import carla
 import numpy as np
 
 from ..scenario_actor.agents.utils.local_planner import LocalPlanner
-from ..scenario_actor.agents.utils.misc import (
-    compute_yaw_difference,
-    is_within_distance_ahead,
-)
 from .criteria import (
     blocked,
     collision,
@@ -54,16 +50,24 @@ class TaskVehicle(object):
         self._route_length = 0.0
 
         self._target_transforms = target_transforms  # transforms
+        self._final_target_xyz = None
 
         self._planner = GlobalRoutePlanner(self._map, resolution=1.0)
         self._action_planner = LocalPlanner(target_speed=target_speed)
         self._global_route = []
+        # (N, 3) xyz of the waypoints in self._global_route and the running route
+        # length at each of them, kept in sync with it
+        self._route_xyz = np.zeros((0, 3), dtype=np.float32)
+        self._route_cum = np.zeros(0, dtype=np.float64)
         self._global_plan_gps = []
         self._global_plan_world_coord = []
 
         self._trace_route_to_global_target()
         self.sub_sample_size = sub_sample_size
         self._spawn_transforms = spawn_transforms
+        # candidate targets for a road id, i.e. the spawn transforms on the other roads,
+        # only built for the roads a target is actually drawn from
+        self._spawn_excluding = {}
 
         self._endless = endless
         if len(self._target_transforms) == 0:
@@ -73,6 +77,12 @@ class TaskVehicle(object):
         self._last_route_location = self.vehicle.get_location()
         self.collision_px = False
 
+        # lights
+        self._weather_poll_interval = 20
+        self._ticks_since_weather_poll = self._weather_poll_interval
+        self._sun_altitude_angle = 0.0
+        self._last_light_state = None
+
     def _update_leaderboard_plan(self, route_trace):
         plan_gps = location_route_to_gps(route_trace)
         ds_ids = downsample_route(route_trace, 50)
@@ -82,6 +92,41 @@ class TaskVehicle(object):
             (route_trace[x][0].transform.location, route_trace[x][1]) for x in ds_ids
         ]
 
+    def _extend_global_route(self, route_trace):
+        """Append route_trace to the global route and return its length in meters."""
+        if len(route_trace) == 0:
+            return 0.0
+
+        route_xyz = np.array(
+            [
+                [wp.transform.location.x, wp.transform.location.y, wp.transform.location.z]
+                for wp, _ in route_trace
+            ],
+            dtype=np.float32,
+        )
+        if len(self._route_xyz) > 0:
+            # also account for the segment joining the existing route
+            seg_len = np.linalg.norm(
+                np.diff(np.concatenate([self._route_xyz[-1:], route_xyz]), axis=0), axis=1
+            )
+            route_cum = self._route_cum[-1] + np.cumsum(seg_len, dtype=np.float64)
+        else:
+            seg_len = np.linalg.norm(np.diff(route_xyz, axis=0), axis=1)
+            route_cum = np.concatenate([[0.0], np.cumsum(seg_len, dtype=np.float64)])
+
+        self._global_route += route_trace
+        self._route_xyz = np.concatenate([self._route_xyz, route_xyz])
+        self._route_cum = np.concatenate([self._route_cum, route_cum])
+        return float(route_cum[-1] - route_cum[0])
+
+    def _truncate_global_route(self, closest_idx):
+        """Drop the waypoints before closest_idx and return the route length dropped."""
+        distance_traveled = float(self._route_cum[closest_idx] - self._route_cum[0])
+        self._global_route = self._global_route[closest_idx:]
+        self._route_xyz = self._route_xyz[closest_idx:]
+        self._route_cum = self._route_cum[closest_idx:]
+        return distance_traveled
+
     def _add_random_target(self):
         if len(self._target_transforms) == 0:
             last_target_loc = self.vehicle.get_location()
@@ -91,115 +136,106 @@ class TaskVehicle(object):
         else:
             last_target_loc = self._target_transforms[-1].location
             last_road_id = self._map.get_waypoint(last_target_loc).road_id
-            new_target_transform = np.random.choice(
-                [x[1] for x in self._spawn_transforms if x[0] != last_road_id]
-            )
+            new_target_transform = np.random.choice(self._get_spawn_excluding(last_road_id))
 
         route_trace = self._planner.trace_route(last_target_loc, new_target_transform.location)
-        self._global_route += route_trace
         self._target_transforms.append(new_target_transform)
-        self._route_length += self._compute_route_length(route_trace)
+        self._update_final_target()
+        self._route_length += self._extend_global_route(route_trace)
         self._update_leaderboard_plan(route_trace)
 
+    def _get_spawn_excluding(self, road_id):
+        candidates = self._spawn_excluding.get(road_id)
+        if candidates is None:
+            candidates = np.array(
+                [x[1] for x in self._spawn_transforms if x[0] != road_id], dtype=object
+            )
+            self._spawn_excluding[road_id] = candidates
+        return candidates
+
     def _trace_route_to_global_target(self):
         current_location = self.vehicle.get_location()
         for tt in self._target_transforms:
             next_target_location = tt.location
             route_trace = self._planner.trace_route(current_location, next_target_location)
-            self._global_route += route_trace
-            self._route_length += self._compute_route_length(route_trace)
+            self._route_length += self._extend_global_route(route_trace)
             current_location = next_target_location
 
+        self._update_final_target()
         self._update_leaderboard_plan(self._global_route)
 
-    @staticmethod
-    def _compute_route_length(route):
-        length_in_m = 0.0
-        for i in range(len(route) - 1):
-            d = route[i][0].transform.location.distance(route[i + 1][0].transform.location)
-            length_in_m += d
-        return length_in_m
-
-    def _truncate_global_route_till_local_target(self, windows_size=5):
-        ev_location = self.vehicle.get_location()
-        closest_idx = 0
-
-        for i in range(len(self._global_route) - 1):
-            if i > windows_size:
-                break
+    def _update_final_target(self):
+        if len(self._target_transforms) > 0:
+            loc = self._target_transforms[-1].location
+            self._final_target_xyz = np.array([loc.x, loc.y, loc.z], dtype=np.float32)
 
-            loc0 = self._global_route[i][0].transform.location
-            loc1 = self._global_route[i + 1][0].transform.location
-
-            wp_dir = loc1 - loc0
-            wp_veh = ev_location - loc0
-            dot_ve_wp = wp_veh.x * wp_dir.x + wp_veh.y * wp_dir.y + wp_veh.z * wp_dir.z
-
-            if dot_ve_wp > 0:
-                closest_idx = i + 1
+    def _truncate_global_route_till_local_target(self, ev_location, windows_size=5):
+        closest_idx = 0
 
-        distance_traveled = self._compute_route_length(self._global_route[: closest_idx + 1])
-        self._route_completed += distance_traveled
+        # segments i -> i + 1 for i in [0, windows_size]
+        num_segments = min(len(self._route_xyz) - 1, windows_size + 1)
+        if num_segments > 0:
+            route_xyz = self._route_xyz[: num_segments + 1]
+            wp_dir = route_xyz[1:] - route_xyz[:-1]
+            wp_veh = (
+                np.array([ev_location.x, ev_location.y, ev_location.z], dtype=np.float32)
+                - route_xyz[:-1]
+            )
+            # the ego vehicle has passed the start of every segment it projects onto positively
+            passed = np.flatnonzero(np.einsum("ij,ij->i", wp_veh, wp_dir) > 0)
+            if len(passed) > 0:
+                closest_idx = int(passed[-1]) + 1
 
         if closest_idx > 0:
             self._last_route_location = carla.Location(self._global_route[0][0].transform.location)
 
-        self._global_route = self._global_route[closest_idx:]
+        distance_traveled = self._truncate_global_route(closest_idx)
+        self._route_completed += distance_traveled
         return distance_traveled
 
-    def _truncate_global_route_till_cumulative_distance(self, min_distance=7, max_distance=50.0):
-        ev_location = np.array([self.vehicle.get_location().x, self.vehicle.get_location().y])
+    def _truncate_global_route_till_cumulative_distance(
+        self, ev_loc, min_distance=7, max_distance=50.0
+    ):
         closest_idx = 0
-        farthest_in_range = -np.inf
-        cumulative_distance = 0.0
-
-        for i in range(1, len(self._global_route)):
-            if cumulative_distance > max_distance:
-                break
-
-            cur_route = np.array(
-                [
-                    self._global_route[i][0].transform.location.x,
-                    self._global_route[i][0].transform.location.y,
-                ]
-            )
-            prev_route = np.array(
-                [
-                    self._global_route[i - 1][0].transform.location.x,
-                    self._global_route[i - 1][0].transform.location.y,
-                ]
-            )
-            cumulative_distance += np.linalg.norm(cur_route - prev_route)
-            distance = np.linalg.norm(cur_route - ev_location)
-
-            if distance <= min_distance and distance > farthest_in_range:
-                farthest_in_range = distance
-                closest_idx = i
 
-        distance_traveled = self._compute_route_length(self._global_route[: closest_idx + 1])
-        self._route_completed += distance_traveled
+        if len(self._route_xyz) > 1:
+            # waypoint i is only considered while the route length up to i - 1 is in range
+            in_range = self._route_cum[:-1] - self._route_cum[0] <= max_distance
+            distance = np.linalg.norm(
+                self._route_xyz[1:, :2] - np.array([ev_loc.x, ev_loc.y], dtype=np.float32),
+                axis=1,
+            )
+            # pick the farthest waypoint that is still within min_distance of the ego vehicle
+            candidates = in_range & (distance <= min_distance)
+            if candidates.any():
+                closest_idx = int(np.argmax(np.where(candidates, distance, -np.inf))) + 1
 
         if closest_idx > 0:
             self._last_route_location = carla.Location(self._global_route[0][0].transform.location)
 
-        self._global_route = self._global_route[closest_idx:]
+        distance_traveled = self._truncate_global_route(closest_idx)
+        self._route_completed += distance_traveled
         return distance_traveled
 
-    def _is_route_completed(self, percentage_threshold=0.99, distance_threshold=10.0):
+    def _is_route_completed(self, ev_loc, percentage_threshold=0.99, distance_threshold=10.0):
         # distance_threshold=10.0
-        ev_loc = self.vehicle.get_location()
-
         percentage_route_completed = self._route_completed / self._route_length
         is_completed = percentage_route_completed > percentage_threshold
-        is_within_dist = ev_loc.distance(self._target_transforms[-1].location) < distance_threshold
+        dx = ev_loc.x - self._final_target_xyz[0]
+        dy = ev_loc.y - self._final_target_xyz[1]
+        dz = ev_loc.z - self._final_target_xyz[2]
+        is_within_dist = dx * dx + dy * dy + dz * dz < distance_threshold * distance_threshold
 
         return is_completed and is_within_dist
 
     def tick(self, timestamp):
-        # distance_traveled = self._truncate_global_route_till_local_target()
-        distance_traveled = self._truncate_global_route_till_cumulative_distance()
+        # query the ego location once per tick and share it with the helpers
+        ev_loc = self.vehicle.get_location()
 
-        route_completed = self._is_route_completed()
+        # distance_traveled = self._truncate_global_route_till_local_target(ev_loc)
+        distance_traveled = self._truncate_global_route_till_cumulative_distance(ev_loc)
+
+        route_completed = self._is_route_completed(ev_loc)
         if self._endless and route_completed:
             self._add_random_target()
             route_completed = False
@@ -239,39 +275,58 @@ class TaskVehicle(object):
             "run_stop_sign": info_stop,
         }
 
-        # turn on light
-        weather = self._world.get_weather()
-        if weather.sun_altitude_angle < 0.0:
+        # turn on light, the weather changes slowly so it is only polled every few ticks
+        if self._ticks_since_weather_poll >= self._weather_poll_interval:
+            self._sun_altitude_angle = self._world.get_weather().sun_altitude_angle
+            self._ticks_since_weather_poll = 0
+        self._ticks_since_weather_poll += 1
+
+        if self._sun_altitude_angle < 0.0:
             vehicle_lights = carla.VehicleLightState.Position | carla.VehicleLightState.LowBeam
         else:
             vehicle_lights = carla.VehicleLightState.NONE
-        self.vehicle.set_light_state(carla.VehicleLightState(vehicle_lights))
+        if vehicle_lights != self._last_light_state:
+            self.vehicle.set_light_state(carla.VehicleLightState(vehicle_lights))
+            self._last_light_state = vehicle_lights
 
         return self._info_criteria
 
-    def _is_vehicle_hazard(self, ev_transform, ev_id, vehicle_list):
-        ego_vehicle_location = ev_transform.location
-        ego_vehicle_orientation = ev_transform.rotation.yaw
-
-        for target_vehicle in vehicle_list:
-            if target_vehicle.id == ev_id:
-                continue
+    @staticmethod
+    def _within_distance_ahead(target_xy, ev_transform, max_distance, degree):
+        """Vectorised misc.is_within_distance_ahead over an (N, 2) array of locations."""
+        rel = target_xy - np.array([ev_transform.location.x, ev_transform.location.y])
+        distance = np.linalg.norm(rel, axis=1)
+        yaw = np.radians(ev_transform.rotation.yaw)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            cos_angle = (rel[:, 0] * np.cos(yaw) + rel[:, 1] * np.sin(yaw)) / distance
+        angle = np.degrees(np.arccos(np.clip(cos_angle, -1.0, 1.0)))
+        return (distance > 0) & (distance <= max_distance) & (angle < degree)
+
+    def _nearby_mask(self, target_xy, ev_transform):
+        # cheap squared-distance prefilter so the trigonometry only runs on nearby actors
+        dx = target_xy[:, 0] - ev_transform.location.x
+        dy = target_xy[:, 1] - ev_transform.location.y
+        return dx * dx + dy * dy <= self._proximity_threshold * self._proximity_threshold
 
-            loc = target_vehicle.get_location()
-            ori = target_vehicle.get_transform().rotation.yaw
+    def _is_vehicle_hazard(self, ev_transform, ev_id, vehicle_list):
+        transforms = [v.get_transform() for v in vehicle_list if v.id != ev_id]
+        if len(transforms) == 0:
+            return False
 
-            if compute_yaw_difference(
-                ego_vehicle_orientation, ori
-            ) <= 150 and is_within_distance_ahead(
-                loc,
-                ego_vehicle_location,
-                ego_vehicle_orientation,
-                self._proximity_threshold,
-                degree=45,
-            ):
-                return True
+        target_xy = np.array([[t.location.x, t.location.y] for t in transforms])
+        nearby = self._nearby_mask(target_xy, ev_transform)
+        if not nearby.any():
+            return False
 
-        return False
+        target_xy = target_xy[nearby]
+        target_yaw = np.array([t.rotation.yaw for t in transforms])[nearby]
+        yaw_diff = np.degrees(
+            np.arccos(np.clip(np.cos(np.radians(target_yaw - ev_transform.rotation.yaw)), -1, 1))
+        )
+        ahead = self._within_distance_ahead(
+            target_xy, ev_transform, self._proximity_threshold, degree=45
+        )
+        return bool(np.any((yaw_diff <= 150) & ahead))
 
     def _is_point_on_sidewalk(self, loc):
         wp = self._map.get_waypoint(loc, project_to_road=False, lane_type=carla.LaneType.Sidewalk)
@@ -281,39 +336,44 @@ class TaskVehicle(object):
             return True
 
     def _is_walker_hazard(self, ev_transform, walkers_list):
-        ego_vehicle_location = ev_transform.location
-
-        for walker in walkers_list:
-            loc = walker.get_location()
-            dist = loc.distance(ego_vehicle_location)
-            degree = 162 / (np.clip(dist, 1.5, 10.5) + 0.3)
-            if self._is_point_on_sidewalk(loc):
-                continue
-
-            if is_within_distance_ahead(
-                loc,
-                ego_vehicle_location,
-                ev_transform.rotation.yaw,
-                self._proximity_threshold,
-                degree=degree,
-            ):
-                return True
-        return False
+        locations = [walker.get_location() for walker in walkers_list]
+        if len(locations) == 0:
+            return False
+
+        ev_loc = ev_transform.location
+        target_xyz = np.array([[loc.x, loc.y, loc.z] for loc in locations])
+        nearby_idx = np.flatnonzero(self._nearby_mask(target_xyz, ev_transform))
+        if len(nearby_idx) == 0:
+            return False
+
+        target_xyz = target_xyz[nearby_idx]
+        dist = np.linalg.norm(target_xyz - np.array([ev_loc.x, ev_loc.y, ev_loc.z]), axis=1)
+        degree = 162 / (np.clip(dist, 1.5, 10.5) + 0.3)
+        ahead = self._within_distance_ahead(
+            target_xyz[:, :2], ev_transform, self._proximity_threshold, degree=degree
+        )
+
+        # the sidewalk lookup goes through the map, so only do it for walkers ahead
+        return any(
+            not self._is_point_on_sidewalk(locations[i]) for i in nearby_idx[np.flatnonzero(ahead)]
+        )
 
     def get_control_to_target(self):
         transform = self.vehicle.get_transform()
         actor_list = self._world.get_actors()
-        vehicle_list = actor_list.filter("*vehicle*")
-        walkers_list = actor_list.filter("*walker*")
-        vehicle_hazard = self._is_vehicle_hazard(transform, self.vehicle.id, vehicle_list)
-        pedestrian_ahead = self._is_walker_hazard(transform, walkers_list)
 
+        # each check only runs if the previous ones found no reason to brake
+        hazard = self._is_vehicle_hazard(
+            transform, self.vehicle.id, actor_list.filter("*vehicle*")
+        )
+        hazard = hazard or self._is_walker_hazard(transform, actor_list.filter("*walker*"))
         # check red light
-        redlight_ahead = self.vehicle.is_at_traffic_light() and (
-            self.vehicle.get_traffic_light().get_state() == carla.TrafficLightState.Red
+        hazard = hazard or (
+            self.vehicle.is_at_traffic_light()
+            and self.vehicle.get_traffic_light().get_state() == carla.TrafficLightState.Red
         )
 
-        if vehicle_hazard or pedestrian_ahead or redlight_ahead:
+        if hazard:
             throttle, steer, brake = 0.0, 0.0, 1.0
         else:
             route_plan = self.route_plan
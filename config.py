@@ -1,3 +1,4 @@
+import functools
 import os.path as osp
 import pprint
 
@@ -6,7 +7,8 @@ from tabulate import tabulate
 from yacs.config import CfgNode as CN
 
 
-def create_cfg():
+@functools.lru_cache(maxsize=1)
+def _build_cfg():
     cfg = CN()
     cfg._BASE_ = None
     cfg.PROJECT_NAME = "carla_diffusion"
@@ -103,6 +105,11 @@ def create_cfg():
     return cfg
 
 
+def create_cfg():
+    # The default tree is built once per process, callers get their own copy to merge into
+    return _build_cfg().clone()
+
+
 def merge_possible_with_base(cfg: CN, config_path):
     with open(config_path, "r") as f:
         new_cfg = cfg.load_cfg(f)
@@ -119,36 +126,19 @@ def split_into(v):
     return res
 
 
-def pretty_print_cfg(cfg):
-    def _indent(s_, num_spaces):
-        s = s_.split("\n")
-        if len(s) == 1:
-            return s_
-        first = s.pop(0)
-        s = [(num_spaces * " ") + line for line in s]
-        s = "\n".join(s)
-        s = first + "\n" + s
-        return s
-
-    r = ""
-    s = []
+def flatten_cfg(cfg, prefix=""):
     for k, v in sorted(cfg.items()):
-        seperator = "\n" if isinstance(v, CN) else " "
-        attr_str = "{}:{}{}".format(
-            str(k),
-            seperator,
-            pretty_print_cfg(v) if isinstance(v, CN) else pprint.pformat(v),
-        )
-        attr_str = _indent(attr_str, 2)
-        s.append(attr_str)
-    r += "\n".join(s)
-    return r
+        key = f"{prefix}.{k}" if prefix else str(k)
+        if isinstance(v, CN):
+            yield from flatten_cfg(v, key)
+        else:
+            yield key, pprint.pformat(v)
 
 
 def show_config(cfg):
     table = tabulate(
-        {"Configuration": [pretty_print_cfg(cfg)]},
-        headers="keys",
+        list(flatten_cfg(cfg)),
+        headers=["Key", "Value"],
         tablefmt="fancy_grid",
     )
     print(f"{Fore.BLUE}", end="")
@@ -9,10 +9,15 @@ This module provides a human agent to control the ego vehicle via keyboard
 
 import time
 import json
-from threading import Thread
+from threading import Event, Lock, Thread
 import cv2
 import numpy as np
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 try:
     import pygame
     from pygame.locals import K_DOWN
@@ -33,6 +38,11 @@ import carla
 from leaderboard.autoagents.autonomous_agent import AutonomousAgent, Track
 
 
+# SDL video and event calls are not thread-safe, every pygame call made after the
+# render thread starts goes through this lock
+_pygame_lock = Lock()
+
+
 def get_entry_point():
     return "HumanAgent"
 
@@ -43,10 +53,11 @@ class HumanInterface(object):
     Class to control a vehicle manually for debugging purposes
     """
 
-    def __init__(self):
-        self._width = 800
-        self._height = 600
-        self._surface = None
+    def __init__(self, width=800, height=600):
+        self._width = width
+        self._height = height
+        # cvtColor only writes into dst in place when it matches the frame shape
+        self._rgb = np.empty((self._height, self._width, 3), dtype=np.uint8)
 
         pygame.init()
         pygame.font.init()
@@ -55,22 +66,54 @@ class HumanInterface(object):
             (self._width, self._height), pygame.HWSURFACE | pygame.DOUBLEBUF
         )
         pygame.display.set_caption("Human Agent")
+        # only QUIT and KEYUP are handled, let SDL drop everything else (e.g. mouse motion)
+        # before it reaches the queue; pygame.key.get_pressed() is unaffected
+        pygame.event.set_blocked(None)
+        pygame.event.set_allowed([pygame.QUIT, pygame.KEYUP])
+        # match the display pixel format so blitting does not convert every frame
+        self._surface = pygame.Surface((self._width, self._height)).convert()
+
+        # single slot holding the latest frame, the render thread drops the ones it misses
+        self._frame = None
+        self._frame_lock = Lock()
+        self._frame_ready = Event()
+        self._stop = Event()
+        self._render_thread = Thread(target=self._render_loop, daemon=True)
+        self._render_thread.start()
 
     def run_interface(self, input_data):
         """
-        Run the GUI
+        Hand the latest frame to the render thread, so the simulation never waits on the flip
         """
+        # the sensor interface copies every frame, so keeping the reference is safe
+        with self._frame_lock:
+            self._frame = input_data["Center"][1]
+            self._frame_ready.set()
 
-        # process sensor data
-        image_center = input_data["Center"][1][:, :, -2::-1]
-
-        # display image
-        self._surface = pygame.surfarray.make_surface(image_center.swapaxes(0, 1))
-        if self._surface is not None:
-            self._display.blit(self._surface, (0, 0))
-        pygame.display.flip()
+    def _render_loop(self):
+        """
+        Run the GUI
+        """
+        while not self._stop.is_set():
+            if not self._frame_ready.wait(timeout=0.1):
+                continue
+            with self._frame_lock:
+                frame = self._frame
+                self._frame = None
+                self._frame_ready.clear()
+
+            # process sensor data
+            image_center = cv2.cvtColor(frame, cv2.COLOR_BGRA2RGB, dst=self._rgb)
+
+            # display image, the swapped view is copied straight into the surface pixels
+            with _pygame_lock:
+                pygame.pixelcopy.array_to_surface(self._surface, image_center.swapaxes(0, 1))
+                self._display.blit(self._surface, (0, 0))
+                pygame.display.flip()
 
     def _quit(self):
+        self._stop.set()
+        self._render_thread.join()
         pygame.quit()
 
 
@@ -90,7 +133,8 @@ class HumanAgent(AutonomousAgent):
         self.track = Track.SENSORS
 
         self.agent_engaged = False
-        self._hic = HumanInterface()
+        center = next(sensor for sensor in self.sensors() if sensor["id"] == "Center")
+        self._hic = HumanInterface(center["width"], center["height"])
         self._controller = KeyboardControl(path_to_conf_file)
         self._prev_timestamp = 0
 
@@ -147,7 +191,7 @@ class HumanAgent(AutonomousAgent):
         """
         Cleanup
         """
-        self._hic._quit = True
+        self._hic._quit()
 
 
 class KeyboardControl(object):
@@ -156,6 +200,9 @@ class KeyboardControl(object):
     Keyboard control for the human agent
     """
 
+    # steering change per millisecond while a steering key is held
+    _STEER_SCALE = 3e-4
+
     def __init__(self, path_to_conf_file):
         """
         Init
@@ -166,10 +213,10 @@ class KeyboardControl(object):
 
         # Get the mode
         if path_to_conf_file:
+            # only the first two lines, `mode: <mode>` and `file: <path>`, are settings
             with open(path_to_conf_file, "r") as f:
-                lines = f.read().split("\n")
-                self._mode = lines[0].split(" ")[1]
-                self._endpoint = lines[1].split(" ")[1]
+                self._mode = f.readline().split()[1]
+                self._endpoint = f.readline().split()[1]
 
             # Get the needed vars
             if self._mode == "log":
@@ -177,32 +224,19 @@ class KeyboardControl(object):
 
             elif self._mode == "playback":
                 self._index = 0
-                self._control_list = []
-
-                with open(self._endpoint) as fd:
-                    try:
-                        self._records = json.load(fd)
-                        self._json_to_control()
-                    except json.JSONDecodeError:
-                        pass
+                self._records = {"records": []}
+
+                with open(self._endpoint, "rb") as fd:
+                    raw = fd.read()
+                try:
+                    # orjson.JSONDecodeError subclasses the stdlib one
+                    self._records = orjson.loads(raw) if orjson else json.loads(raw)
+                except json.JSONDecodeError:
+                    pass
         else:
             self._mode = "normal"
             self._endpoint = None
 
-    def _json_to_control(self):
-        # transform strs into VehicleControl commands
-        for entry in self._records["records"]:
-            control = carla.VehicleControl(
-                throttle=entry["control"]["throttle"],
-                steer=entry["control"]["steer"],
-                brake=entry["control"]["brake"],
-                hand_brake=entry["control"]["hand_brake"],
-                reverse=entry["control"]["reverse"],
-                manual_gear_shift=entry["control"]["manual_gear_shift"],
-                gear=entry["control"]["gear"],
-            )
-            self._control_list.append(control)
-
     def parse_events(self, timestamp):
         """
         Parse the keyboard events and set the vehicle controls accordingly
@@ -211,7 +245,10 @@ class KeyboardControl(object):
         if self._mode == "playback":
             self._parse_json_control()
         else:
-            self._parse_vehicle_keys(pygame.key.get_pressed(), timestamp * 1000)
+            with _pygame_lock:
+                keys = pygame.key.get_pressed()
+                events = pygame.event.get()
+            self._parse_vehicle_keys(keys, events, timestamp * 1000)
 
         # Record the control
         if self._mode == "log":
@@ -219,12 +256,12 @@ class KeyboardControl(object):
 
         return self._control
 
-    def _parse_vehicle_keys(self, keys, milliseconds):
+    def _parse_vehicle_keys(self, keys, events, milliseconds):
         """
         Calculate new vehicle controls based on input keys
         """
 
-        for event in pygame.event.get():
+        for event in events:
             if event.type == pygame.QUIT:
                 return
             elif event.type == pygame.KEYUP:
@@ -232,27 +269,28 @@ class KeyboardControl(object):
                     self._control.gear = 1 if self._control.reverse else -1
                     self._control.reverse = self._control.gear < 0
 
-        if keys[K_UP] or keys[K_w]:
-            self._control.throttle = 0.6
-        else:
-            self._control.throttle = 0.0
+        control = self._control
+        control.throttle = 0.6 if keys[K_UP] or keys[K_w] else 0.0
 
-        steer_increment = 3e-4 * milliseconds
+        steer_cache = self._steer_cache
         if keys[K_LEFT] or keys[K_a]:
-            self._steer_cache -= steer_increment
+            steer_cache -= self._STEER_SCALE * milliseconds
         elif keys[K_RIGHT] or keys[K_d]:
-            self._steer_cache += steer_increment
+            steer_cache += self._STEER_SCALE * milliseconds
         else:
-            self._steer_cache = 0.0
+            steer_cache = 0.0
+        self._steer_cache = steer_cache
 
-        steer_cache = min(0.95, max(-0.95, self._steer_cache))
-        self._control.steer = round(self._steer_cache, 1)
-        self._control.brake = 1.0 if keys[K_DOWN] or keys[K_s] else 0.0
-        self._control.hand_brake = keys[K_SPACE]
+        # round to one decimal, half away from zero, without going through round()
+        control.steer = int(steer_cache * 10.0 + (0.5 if steer_cache >= 0.0 else -0.5)) / 10.0
+        control.brake = 1.0 if keys[K_DOWN] or keys[K_s] else 0.0
+        control.hand_brake = keys[K_SPACE]
 
     def _parse_json_control(self):
-        if self._index < len(self._control_list):
-            self._control = self._control_list[self._index]
+        records = self._records["records"]
+        if self._index < len(records):
+            # build the command only when it is replayed, records hold the _record_control fields
+            self._control = carla.VehicleControl(**records[self._index]["control"])
             self._index += 1
         else:
             print("JSON file has no more entries")
@@ -273,7 +311,9 @@ class KeyboardControl(object):
         self._log_data["records"].append(new_record)
 
     def __del__(self):
-        # Get ready to log user commands
-        if self._mode == "log" and self._log_data:
+        # Get ready to log user commands, __init__ may have failed before the mode was read
+        if getattr(self, "_mode", None) != "log":
+            return
+        if self._log_data:
             with open(self._endpoint, "w") as fd:
                 json.dump(self._log_data, fd, indent=4, sort_keys=True)
@@ -2,15 +2,13 @@ import argparse
 import glob
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import carla
 import cv2
 import numpy as np
-import torch
-import torch.nn.functional
 from create_agent import create_env, create_server
 from hydra import compose, initialize
-from PIL import Image
 
 
 def parse_args():
@@ -43,9 +41,29 @@ def get_random_seed():
     return t
 
 
+# Pixel offsets (dy, dx) covered by `cv2.circle(img, center, 3, color, -1)`
+_DOT_OFFSETS = np.argwhere(cv2.circle(np.zeros((7, 7), dtype=np.uint8), (3, 3), 3, 1, -1)) - 3
+
+
+def draw_dots(image, pixels, color):
+    """Draw a filled radius-3 dot at every (x, y) in `pixels` with one assignment."""
+    ys = (pixels[:, 1, None] + _DOT_OFFSETS[None, :, 0]).reshape(-1)
+    xs = (pixels[:, 0, None] + _DOT_OFFSETS[None, :, 1]).reshape(-1)
+    inside = (ys >= 0) & (ys < image.shape[0]) & (xs >= 0) & (xs < image.shape[1])
+    image[ys[inside], xs[inside]] = color
+    return image
+
+
+def save_png(path, rgb_image):
+    # Level 1 deflate is several times faster to encode than the default of PIL
+    bgr_image = cv2.cvtColor(rgb_image, cv2.COLOR_RGB2BGR)
+    if not cv2.imwrite(path, bgr_image, [cv2.IMWRITE_PNG_COMPRESSION, 1]):
+        raise IOError(f"Failed to write {path}")
+
+
 def way_point_to_pixel(waypoint):
     pixel_val = waypoint / 23.315 * 256
-    return int(256 - pixel_val)
+    return (256 - pixel_val).astype(np.int32)
 
 
 class Agent:
@@ -59,13 +77,13 @@ class Agent:
         off_screen,
         seed,
     ):
+        self.stopped = False
         with initialize(config_path="../configs", version_base="1.3.2"):
             cfg = compose(config_name=env_config_path)
         self.server_manager = create_server(cfg, off_screen)
         self.env = create_env(cfg, self.server_manager, seed)
         self.cfg = cfg
 
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self.magic_number = 23.315
 
         self.save_root = save_root
@@ -84,33 +102,49 @@ class Agent:
         self.step_to_reset = step_to_reset
         self.car_agent = None
 
+        # PNG encoding releases the GIL, so it overlaps with stepping the simulator
+        self.io_pool = ThreadPoolExecutor(max_workers=2)
+        self.pending_saves = []
+
+    def save_image(self, path, rgb_image):
+        self.pending_saves.append(self.io_pool.submit(save_png, path, rgb_image))
+
+    def wait_for_saves(self):
+        # Surfaces any write error and keeps at most one sample's images in flight
+        for future in self.pending_saves:
+            future.result()
+        self.pending_saves.clear()
+
+    def stop_server(self):
+        # Both run and __del__ end up here, only stop the server once
+        if self.stopped or not hasattr(self, "server_manager"):
+            return
+        self.stopped = True
+        self.server_manager.stop()
+        print("Finished!")
+
     def do_buffer(self, num_buffer):
+        # A synchronous CARLA world advances one frame per tick, so the frames cannot be batched.
+        # Stepping the inner env skips the observation copies DummyVecEnv makes for frames that
+        # are thrown away; episode ends are handled the way its auto-reset would.
+        env = self.env.envs[0]
         for _ in range(num_buffer):
-            self.env.step({0: None})
+            _, _, terminated, truncated, _ = env.step(None)
+            if terminated or truncated:
+                self.env.reset()
+                self.get_car_agent()
 
     def get_car_agent(self):
         ev_handler = self.env.envs[0].env.unwrapped.ev_handler
         if ev_handler is not None:
             self.car_agent = ev_handler.ego_vehicles["hero"].vehicle
 
-    def world_to_agent(self, world_pos, agent_pos, agent_yaw):
-        x, y = world_pos
-        x -= agent_pos[0]
-        y -= agent_pos[1]
-        theta = agent_yaw
-        R = np.array(
-            [
-                [np.cos(theta), -np.sin(theta)],
-                [np.sin(theta), np.cos(theta)],
-            ]
-        )
-        x, y = R.T.dot(np.array([x, y])).reshape(-1)
-        return x, y
-
     def run(self):
         state = self.env.reset()
         self.get_car_agent()
-        cur_traj = []
+        # Each row holds the (x, y) position and the 5 state values of one frame of the sample
+        cur_traj = np.empty((self.total_frame_should_pass + 1, 7))
+        traj_len = 0
         target_bev = None
         init_compass = 0.0
         target_pos = None
@@ -119,6 +153,8 @@ class Agent:
         step_to_reset = 0
 
         self.do_buffer(self.buffer_frames)
+        # DictConfig attribute access is slow, read the config value once
+        target_speed = self.cfg.envs.env_configs.target_speed
 
         while self.cur_save < self.total_to_save:
             if not prev_red:
@@ -126,88 +162,89 @@ class Agent:
             else:
                 input_control = {0: np.array([0.0, 0.0, 1.0])}
             state, _, done, *_ = self.env.step(input_control)
-            cur_pos = state["cur_waypoint"][0]
-            cur_control = state["state"][0][:5]
-            cur_control[0] = cur_control[0] / 180  # yaw
-            cur_control[1] = cur_control[1] / self.cfg.envs.env_configs.target_speed  # speed
-            camera = state["camera"][0]
-            bev = state["bev"][0]
 
             # If the episode is done, clear the current trajectory to avoid inconsistency
             if done:
-                cur_traj.clear()
+                traj_len = 0
                 count_to_collect = 0
                 step_to_reset = 0
                 self.do_buffer(self.buffer_frames)
                 self.get_car_agent()
                 continue
 
-            if state["at_red_light"][0] == 1 and prev_red:
+            at_red_light = state["at_red_light"][0] == 1
+            if at_red_light and prev_red:
                 continue
 
             if count_to_collect % self.save_every_n_frame != 0:
                 count_to_collect += 1
                 continue
 
-            if len(cur_traj) == 0:
+            # Only read the observations of frames that are actually collected
+            cur_pos = state["cur_waypoint"][0]
+            if traj_len == 0:
+                self.wait_for_saves()
                 save_front_path = os.path.join(self.save_root, "front", f"{self.cur_save:06d}.png")
-                Image.fromarray(camera).save(save_front_path)
-                target_bev = np.copy(bev)
+                self.save_image(save_front_path, state["camera"][0])
+                target_bev = np.copy(state["bev"][0])
                 init_compass = state["compass"][0]
                 target_pos = state["next_waypoint"][0]
 
-                if state["at_red_light"][0] == 1:
-                    for _ in range(self.total_frame_should_pass):
-                        cur_traj.append(
-                            np.concatenate([cur_pos, np.array([0.0, 0.0, 0.0, 0.0, 1.0])])
-                        )
-                        prev_red = True
+                if at_red_light:
+                    cur_traj[: self.total_frame_should_pass, :2] = cur_pos
+                    cur_traj[: self.total_frame_should_pass, 2:] = (0.0, 0.0, 0.0, 0.0, 1.0)
+                    traj_len = self.total_frame_should_pass
+                    prev_red = True
                 else:
                     prev_red = False
 
-            if len(cur_traj) < self.total_frame_should_pass + 1:
-                cur_traj.append(np.concatenate((cur_pos, cur_control)))
+            if traj_len < self.total_frame_should_pass + 1:
+                cur_control = state["state"][0][:5]
+                cur_control[0] = cur_control[0] / 180  # yaw
+                cur_control[1] = cur_control[1] / target_speed  # speed
+                cur_traj[traj_len, :2] = cur_pos
+                cur_traj[traj_len, 2:] = cur_control
+                traj_len += 1
 
-            if len(cur_traj) != self.total_frame_should_pass + 1:
+            if traj_len != self.total_frame_should_pass + 1:
                 count_to_collect += 1
             else:
                 save_bev_path = os.path.join(self.save_root, "bev", f"{self.cur_save:06d}.png")
-                added_traj = []
                 theta = init_compass + np.pi / 2
-                for idx in range(len(cur_traj) - 1):
-                    traj = np.copy(cur_traj[idx][:2])
-                    car_state = np.copy(cur_traj[idx][2:4])
-                    action = np.copy(cur_traj[idx + 1][-3:])
-                    car_state[0] -= cur_traj[0][2]
-                    if car_state[0] > 1:
-                        car_state[0] -= 1
-                    elif car_state[0] < -1:
-                        car_state[0] += 1
-                    traj = self.world_to_agent(traj, cur_traj[0][:2], theta)
-                    pixel_x = way_point_to_pixel(traj[1])
-                    pixel_y = way_point_to_pixel(-traj[0])
-                    target_bev = cv2.circle(
-                        target_bev, (int(pixel_x), int(pixel_y)), 3, (0, 255, 0), -1
-                    )
-                    added_traj.append(
-                        (
-                            traj[1] / self.magic_number,
-                            -traj[0] / self.magic_number,
-                            *car_state.tolist(),
-                            *action.tolist(),
-                        )
-                    )
-                target_pos_traj = self.world_to_agent(target_pos, cur_traj[0][:2], theta)
+                # Rotate every point into the agent frame at once, `p @ R` is `R.T.dot(p)`
+                cos_theta, sin_theta = np.cos(theta), np.sin(theta)
+                rotation = np.array([[cos_theta, -sin_theta], [sin_theta, cos_theta]])
+                traj = (cur_traj[:-1, :2] - cur_traj[0, :2]) @ rotation
+                car_state = cur_traj[:-1, 2:4] - np.array([cur_traj[0, 2], 0.0])
+                car_state[car_state[:, 0] > 1, 0] -= 1
+                car_state[car_state[:, 0] < -1, 0] += 1
+                action = cur_traj[1:, -3:]
+
+                pixels = np.stack(
+                    [way_point_to_pixel(traj[:, 1]), way_point_to_pixel(-traj[:, 0])], axis=1
+                )
+                target_bev = draw_dots(target_bev, pixels, (0, 255, 0))
+                added_traj = np.column_stack(
+                    [
+                        traj[:, 1] / self.magic_number,
+                        -traj[:, 0] / self.magic_number,
+                        car_state,
+                        action,
+                    ]
+                ).tolist()
+                # The target waypoint goes through the same rotation as the trajectory
+                target_pos_traj = (target_pos - cur_traj[0, :2]) @ rotation
+                # Format the whole file up front and hand it to a single write
+                lines = [
+                    f"{target_pos_traj[1] / self.magic_number} {-target_pos_traj[0] / self.magic_number}"
+                ]
+                lines.extend(" ".join(map(str, traj)) for traj in added_traj)
                 with open(
                     os.path.join(self.save_root, "waypoints", f"{self.cur_save:06d}.txt"), "w"
                 ) as f:
-                    f.write(
-                        f"{target_pos_traj[1] / self.magic_number} {-target_pos_traj[0] / self.magic_number}\n"
-                    )
-                    for traj in added_traj:
-                        f.write(f"{' '.join(map(str, traj))}\n")
-                Image.fromarray(target_bev).save(save_bev_path)
-                cur_traj.clear()
+                    f.write("\n".join(lines) + "\n")
+                self.save_image(save_bev_path, target_bev)
+                traj_len = 0
                 self.cur_save += 1
                 count_to_collect = 0
 
@@ -233,12 +270,12 @@ class Agent:
                 self.do_buffer(self.buffer_frames)
             step_to_reset += 1
 
-        self.server_manager.stop()
-        print("Finished!")
+        self.wait_for_saves()
+        self.io_pool.shutdown(wait=True)
+        self.stop_server()
 
     def __del__(self):
-        self.server_manager.stop()
-        print("Finished!")
+        self.stop_server()
 
 
 if __name__ == "__main__":